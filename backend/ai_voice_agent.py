@@ -1,13 +1,25 @@
 import os
-import tempfile
-from groq import Groq, APIError
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import FileResponse
+import re
+import orjson
+import textwrap
+import hashlib
+import asyncio
+import httpx
+from anyio import to_thread
+from cachetools import LRUCache
+try:
+    import numpy as np  # optional, only needed for the semantic cache
+except ImportError:
+    np = None
+from contextlib import AsyncExitStack
+from urllib.parse import quote
+from groq import AsyncGroq, APIError
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter, ValidationError
 from typing import List, Dict
 import uvicorn
-import asyncio
 from dotenv import load_dotenv
 import logging
 
@@ -21,82 +33,252 @@ load_dotenv()
 # === Configuration ===
 DURATION = 5  # seconds to record query
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
-app = FastAPI()
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "6"))  # prior turns sent to the LLM
+TTS_CHUNK_CHARS = 300  # max characters per TTS request
+TTS_CONCURRENCY = 4  # parallel buffered TTS requests (multi-chunk /tts and /converse)
+CORS_ORIGIN_REGEX = os.getenv("CORS_ORIGIN_REGEX", r"^https?://(localhost|127\.0\.0\.1|192\.168\.\d+\.\d+)(:\d+)?$")
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2048"))
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # min cosine similarity
+SEMANTIC_CACHE_ENTRIES = 1024  # prompts kept per conversation context
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", os.path.expanduser("~/.cache/fastembed"))
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # CORS setup to allow frontend communication
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origin_regex=CORS_ORIGIN_REGEX,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Transcription"],
 )
 
 # === Initialize Groq Client ===
-groq_client = Groq(api_key=GROQ_API_KEY)
+# One pooled HTTP client shared by every request so keep-alive/HTTP2 connections
+# to the Groq API are reused instead of re-negotiating TLS each time
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    http2=True,
+    timeout=30,
+)
+groq_client = AsyncGroq(api_key=GROQ_API_KEY, http_client=http_client)
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await http_client.aclose()
+
+# === Response Cache ===
+# Identical (model, messages) requests return the previous completion instead of
+# calling the LLM again
+response_cache = LRUCache(maxsize=RESPONSE_CACHE_SIZE)
+
+def response_cache_key(model, messages):
+    payload = orjson.dumps({"model": model, "messages": messages}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+# === Semantic Response Cache ===
+# Paraphrased prompts reuse a previous completion when their embedding is close
+# enough to a cached prompt with the same preceding conversation. Optional
+# because it needs the packages in requirements-semantic-cache.txt.
+semantic_cache = LRUCache(maxsize=RESPONSE_CACHE_SIZE)  # context key -> (embeddings, responses)
+embedding_model = None
+if SEMANTIC_CACHE_ENABLED:
+    try:
+        from fastembed import TextEmbedding
+    except ImportError as e:
+        raise ImportError(
+            "SEMANTIC_CACHE_ENABLED requires the packages in requirements-semantic-cache.txt"
+        ) from e
+    embedding_model = TextEmbedding("sentence-transformers/all-MiniLM-L6-v2", cache_dir=EMBEDDING_CACHE_DIR)
+
+def embed_prompt(prompt):
+    # Returns a unit-length vector so a dot product gives cosine similarity
+    embedding = next(iter(embedding_model.embed([prompt])))
+    return embedding / np.linalg.norm(embedding)
+
+async def semantic_cache_lookup(model, messages):
+    # Only the final user prompt is compared; everything before it must match exactly
+    context_key = response_cache_key(model, messages[:-1])
+    embedding = await to_thread.run_sync(embed_prompt, messages[-1]["content"])
+    cached_text = None
+    entry = semantic_cache.get(context_key)
+    if entry is not None:
+        embeddings, responses = entry
+        scores = embeddings @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] >= SEMANTIC_CACHE_THRESHOLD:
+            logger.debug("Semantic cache hit: %s (similarity %.3f)", context_key, scores[best])
+            cached_text = responses[best]
+    return context_key, embedding, cached_text
 
-# === Pydantic Model for /generate_response and /tts ===
+def semantic_cache_store(context_key, embedding, ai_text):
+    entry = semantic_cache.get(context_key)
+    if entry is None:
+        embeddings, responses = embedding[np.newaxis, :], [ai_text]
+    else:
+        embeddings = np.vstack([entry[0], embedding])[-SEMANTIC_CACHE_ENTRIES:]
+        responses = (entry[1] + [ai_text])[-SEMANTIC_CACHE_ENTRIES:]
+    semantic_cache[context_key] = (embeddings, responses)
+
+# === Pydantic Model for /generate_response, /generate_response/stream and /tts ===
 class PromptRequest(BaseModel):
     prompt: str
     chat_history: List[Dict[str, str]] = []
 
+# /converse receives chat_history as a JSON form field, validated to the same shape
+chat_history_adapter = TypeAdapter(List[Dict[str, str]])
+
 # === Step 2: Transcribe Audio ===
-async def transcribe_audio(file: UploadFile):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
-        content = await file.read()
-        tmp_file.write(content)
-        tmp_file_path = tmp_file.name
+def sniff_audio_format(header):
+    # Identify the container from its magic bytes so Whisper gets the real format
+    if header[:4] == b"RIFF" and header[8:12] == b"WAVE":
+        return ".wav", "audio/wav"
+    if header[:4] == b"OggS":
+        return ".ogg", "audio/ogg"
+    if header[:4] == b"\x1a\x45\xdf\xa3":
+        return ".webm", "audio/webm"
+    if header[:4] == b"fLaC":
+        return ".flac", "audio/flac"
+    if header[4:8] == b"ftyp":
+        return ".m4a", "audio/mp4"
+    if header[:3] == b"ID3" or (len(header) > 1 and header[0] == 0xFF and header[1] & 0xE0 == 0xE0):
+        return ".mp3", "audio/mpeg"
+    return None
 
-    try:
-        with open(tmp_file_path, "rb") as audio_file:
-            transcription = groq_client.audio.transcriptions.create(
-                file=audio_file,
-                model="whisper-large-v3-turbo",
-                language="en",
-                response_format="verbose_json"
-            )
-        return transcription.text
-    finally:
-        os.remove(tmp_file_path)
+async def read_audio_upload(file: UploadFile):
+    header = await file.read(12)
+    await file.seek(0)
+    audio_format = sniff_audio_format(header)
+    if audio_format is None:
+        if not (file.content_type or "").startswith("audio/"):
+            raise HTTPException(status_code=400, detail="Unsupported audio format")
+        return (file.filename, file.file, file.content_type)
+    extension, content_type = audio_format
+    filename = os.path.splitext(file.filename or "audio")[0] + extension
+    # Hand the spooled upload straight to the SDK rather than buffering it here
+    return (filename, file.file, content_type)
+
+async def transcribe_audio(audio_tuple):
+    transcription = await groq_client.audio.transcriptions.create(
+        file=audio_tuple,
+        model="whisper-large-v3-turbo",
+        language="en",
+        response_format="json"
+    )
+    return transcription.text
 
 # === Step 3: AI Response ===
-def get_ai_response(prompt, chat_history, model="llama3-70b-8192"):
+# Built once and shared read-only by every request's message list
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful AI assistant. Use the full conversation history to respond, especially for questions about previous interactions. If asked 'What did I ask you last?' or similar, refer to the most recent user message in the history."}
+
+def build_messages(prompt, chat_history):
+    # Log the received chat history
+    logger.debug("Received chat_history: %s", chat_history)
+
+    # Construct the messages array with chat history
+    messages = [SYSTEM_MESSAGE]
+    # Only the most recent turns are sent so prompt size stays bounded
+    recent_history = chat_history[-CHAT_HISTORY_WINDOW:] if CHAT_HISTORY_WINDOW > 0 else []
+    for chat in recent_history:
+        if "user" in chat and "ai" in chat:
+            messages.append({"role": "user", "content": chat["user"]})
+            messages.append({"role": "assistant", "content": chat["ai"]})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+async def get_ai_response(prompt, chat_history, model="llama3-70b-8192"):
     try:
-        # Log the received chat history
-        logger.debug("Received chat_history: %s", chat_history)
-        
-        # Construct the messages array with chat history
-        messages = [{"role": "system", "content": "You are a helpful AI assistant. Use the full conversation history to respond, especially for questions about previous interactions. If asked 'What did I ask you last?' or similar, refer to the most recent user message in the history."}]
-        for chat in chat_history:
-            if "user" in chat and "ai" in chat:
-                messages.append({"role": "user", "content": chat["user"]})
-                messages.append({"role": "assistant", "content": chat["ai"]})
-        messages.append({"role": "user", "content": prompt})
+        messages = build_messages(prompt, chat_history)
+        if RESPONSE_CACHE_ENABLED:
+            cache_key = response_cache_key(model, messages)
+            if cache_key in response_cache:
+                logger.debug("Response cache hit: %s", cache_key)
+                return response_cache[cache_key]
+        if SEMANTIC_CACHE_ENABLED:
+            context_key, embedding, cached_text = await semantic_cache_lookup(model, messages)
+            if cached_text is not None:
+                return cached_text
+
         logger.debug("Messages sent to Groq API: %s", messages)
-        response = groq_client.chat.completions.create(
+        response = await groq_client.chat.completions.create(
             model=model,
             messages=messages
         )
-        
-        return response.choices[0].message.content
+
+        ai_text = response.choices[0].message.content
+        if RESPONSE_CACHE_ENABLED:
+            response_cache[cache_key] = ai_text
+        if SEMANTIC_CACHE_ENABLED:
+            semantic_cache_store(context_key, embedding, ai_text)
+        return ai_text
     except APIError as e:
         logger.error("API Error: %s", str(e))
         raise HTTPException(status_code=400, detail=str(e))
 
-# === Step 4: TTS Generation ===
-def generate_tts(text, voice="Fritz-PlayAI", model="playai-tts"):
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp_file:
-        speech_path = tmp_file.name
+async def stream_ai_response(prompt, chat_history, model="llama3-70b-8192"):
+    # Start the completion stream up front so API errors surface here, then
+    # hand back an iterator over the text deltas as they arrive
+    messages = build_messages(prompt, chat_history)
+    cache_key = response_cache_key(model, messages) if RESPONSE_CACHE_ENABLED else None
+    cached_text = None
+    if cache_key is not None and cache_key in response_cache:
+        logger.debug("Response cache hit: %s", cache_key)
+        cached_text = response_cache[cache_key]
+    elif SEMANTIC_CACHE_ENABLED:
+        context_key, embedding, cached_text = await semantic_cache_lookup(model, messages)
+
+    if cached_text is not None:
+        async def cached_deltas():
+            yield cached_text
+
+        return cached_deltas()
+
     try:
-        response = groq_client.audio.speech.create(
+        logger.debug("Messages sent to Groq API: %s", messages)
+        stream = await groq_client.chat.completions.create(
             model=model,
-            voice=voice,
-            input=text,
-            response_format="wav"
+            messages=messages,
+            stream=True
         )
-        response.write_to_file(speech_path)
-        return speech_path
     except APIError as e:
+        logger.error("API Error: %s", str(e))
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def deltas():
+        parts = []
+        try:
+            async for chunk in stream:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            await stream.close()
+        ai_text = "".join(parts)
+        if cache_key is not None:
+            response_cache[cache_key] = ai_text
+        if SEMANTIC_CACHE_ENABLED:
+            semantic_cache_store(context_key, embedding, ai_text)
+
+    return deltas()
+
+# === Step 4: TTS Generation ===
+async def generate_tts(text, voice="Fritz-PlayAI", model="playai-tts"):
+    # Open the streaming response up front so API errors surface here, then
+    # hand back an iterator that forwards audio chunks as Groq produces them
+    stack = AsyncExitStack()
+    try:
+        response = await stack.enter_async_context(
+            groq_client.audio.speech.with_streaming_response.create(
+                model=model,
+                voice=voice,
+                input=text,
+                response_format="wav"
+            )
+        )
+    except APIError as e:
+        await stack.aclose()
         if "terms acceptance" in str(e).lower():
             raise HTTPException(
                 status_code=400,
@@ -108,13 +290,135 @@ def generate_tts(text, voice="Fritz-PlayAI", model="playai-tts"):
             raise HTTPException(status_code=400, detail="Input text too long for TTS processing. Please try a shorter response.")
         raise HTTPException(status_code=400, detail=str(e))
 
+    async def audio_chunks():
+        async with stack:
+            async for chunk in response.iter_bytes():
+                yield chunk
+
+    return audio_chunks()
+
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+# Caps the buffered synthesis used by multi-chunk /tts and /converse. A
+# single-chunk /tts streams straight from Groq and does not take a slot, since
+# nothing would release it if the client disconnected before streaming began.
+tts_semaphore = asyncio.Semaphore(TTS_CONCURRENCY)
+
+async def synthesize_speech(text):
+    async with tts_semaphore:
+        audio_chunks = await generate_tts(text)
+        return b"".join([chunk async for chunk in audio_chunks])
+
+async def synthesize_chunks(chunks):
+    # Synthesize chunks concurrently, cancelling the rest as soon as one fails
+    tasks = [asyncio.create_task(synthesize_speech(chunk)) for chunk in chunks]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+def chunk_text(text, max_chars=TTS_CHUNK_CHARS):
+    # Greedily pack whole sentences into chunks of at most max_chars, only
+    # breaking inside a sentence when it is longer than max_chars on its own
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_BOUNDARY.split(text.strip()):
+        for piece in textwrap.wrap(sentence, max_chars):
+            if current and len(current) + 1 + len(piece) <= max_chars:
+                current += " " + piece
+            else:
+                if current:
+                    chunks.append(current)
+                current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+# === WAV Helpers ===
+def split_wav(data):
+    # Split a WAV file into its header (up to the data chunk) and PCM payload
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id = data[offset:offset + 4]
+        chunk_size = int.from_bytes(data[offset + 4:offset + 8], "little")
+        if chunk_id == b"data":
+            return data[:offset + 8], data[offset + 8:]
+        offset += 8 + chunk_size + (chunk_size & 1)
+    raise ValueError("WAV data chunk not found")
+
+def streaming_wav_header(header):
+    # Mark the RIFF and data sizes as unknown so players read until end of stream
+    unknown_size = (0xFFFFFFFF).to_bytes(4, "little")
+    return header[:4] + unknown_size + header[8:-4] + unknown_size
+
+def join_wav(clips):
+    # Concatenate WAV clips by keeping the first header and appending PCM data
+    header, _ = split_wav(clips[0])
+    pcm = b"".join(split_wav(clip)[1] for clip in clips)
+    riff_size = (len(header) - 8 + len(pcm)).to_bytes(4, "little")
+    data_size = len(pcm).to_bytes(4, "little")
+    return header[:4] + riff_size + header[8:-4] + data_size + pcm
+
+# === Step 5: Conversation Pipeline ===
+async def split_sentences(deltas):
+    buffer = ""
+    async for delta in deltas:
+        buffer += delta
+        *sentences, buffer = SENTENCE_BOUNDARY.split(buffer)
+        for sentence in sentences:
+            if sentence.strip():
+                yield sentence.strip()
+    if buffer.strip():
+        yield buffer.strip()
+
+async def converse_audio(deltas):
+    # TTS for each sentence starts as soon as the LLM finishes it, while the
+    # audio is still yielded in sentence order as one continuous WAV stream
+    tts_tasks = asyncio.Queue()
+
+    async def dispatch():
+        try:
+            async for sentence in split_sentences(deltas):
+                # Long sentences are split so no TTS request exceeds TTS_CHUNK_CHARS
+                for chunk in chunk_text(sentence):
+                    await tts_tasks.put(asyncio.create_task(synthesize_speech(chunk)))
+        finally:
+            await tts_tasks.put(None)
+
+    dispatcher = asyncio.create_task(dispatch())
+    try:
+        first_clip = True
+        while (task := await tts_tasks.get()) is not None:
+            header, pcm = split_wav(await task)
+            if first_clip:
+                yield streaming_wav_header(header)
+                first_clip = False
+            yield pcm
+        await dispatcher
+    except Exception as e:
+        # The response headers are already sent, so end the audio here rather
+        # than letting the error escape mid-stream
+        logger.error("Conversation stream failed: %s", str(e))
+    finally:
+        dispatcher.cancel()
+        await asyncio.gather(dispatcher, return_exceptions=True)
+        pending = []
+        while not tts_tasks.empty():
+            task = tts_tasks.get_nowait()
+            if task is not None:
+                task.cancel()
+                pending.append(task)
+        await asyncio.gather(*pending, return_exceptions=True)
+        await deltas.aclose()
+
 # === API Endpoints ===
 @app.post("/transcribe")
 async def transcribe_endpoint(file: UploadFile = File(...)):
-    if not file.filename.endswith(".wav"):
-        raise HTTPException(status_code=400, detail="Only WAV files are supported")
+    audio_tuple = await read_audio_upload(file)
     try:
-        text = await transcribe_audio(file)
+        text = await transcribe_audio(audio_tuple)
         if not text.strip():
             raise HTTPException(status_code=400, detail="Transcription is empty")
         return {"transcription": text}
@@ -128,25 +432,77 @@ async def generate_response_endpoint(request: PromptRequest):
     try:
         if not request.prompt.strip():
             raise HTTPException(status_code=422, detail="Prompt cannot be empty")
-        ai_text = get_ai_response(request.prompt, request.chat_history)
+        ai_text = await get_ai_response(request.prompt, request.chat_history)
         return {"response": ai_text}
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/generate_response/stream")
+async def generate_response_stream_endpoint(request: PromptRequest):
+    try:
+        if not request.prompt.strip():
+            raise HTTPException(status_code=422, detail="Prompt cannot be empty")
+        deltas = await stream_ai_response(request.prompt, request.chat_history)
+
+        async def events():
+            async for delta in deltas:
+                yield b"data: " + orjson.dumps({"t": delta}) + b"\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @app.post("/tts")
 async def tts_endpoint(request: PromptRequest):
     try:
         if not request.prompt.strip():
             raise HTTPException(status_code=422, detail="Text cannot be empty")
-        speech_path = generate_tts(request.prompt)
-        return FileResponse(speech_path, media_type="audio/wav", filename="response.wav")
+        chunks = chunk_text(request.prompt)
+        if len(chunks) == 1:
+            # Not limited by tts_semaphore; see its definition
+            audio_chunks = await generate_tts(chunks[0])
+        else:
+            # Long replies are synthesized in parallel and stitched back together
+            clips = await synthesize_chunks(chunks)
+            audio_chunks = iter([join_wav(clips)])
+        return StreamingResponse(
+            audio_chunks,
+            media_type="audio/wav",
+            headers={"Content-Disposition": 'attachment; filename="response.wav"'}
+        )
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/converse")
+async def converse_endpoint(file: UploadFile = File(...), chat_history: str = Form("[]")):
+    # Reject a bad chat_history before paying for a transcription
+    try:
+        history = chat_history_adapter.validate_json(chat_history)
+    except ValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors(include_url=False, include_context=False))
+    try:
+        text = await transcribe_audio(await read_audio_upload(file))
+        if not text.strip():
+            raise HTTPException(status_code=400, detail="Transcription is empty")
+        deltas = await stream_ai_response(text, history)
+        return StreamingResponse(
+            converse_audio(deltas),
+            media_type="audio/wav",
+            headers={"X-Transcription": quote(text)}
+        )
+    except HTTPException as e:
+        raise e
+    except APIError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 # === Main (for local testing) ===
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,4 @@
+import os
+
+# The Groq client refuses to start without a key; tests never hit the API
+os.environ.setdefault("GROQ_API_KEY", "test")
@@ -0,0 +1,483 @@
+import asyncio
+import io
+import wave
+from types import SimpleNamespace
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
+
+import ai_voice_agent
+from ai_voice_agent import (
+    chunk_text,
+    join_wav,
+    read_audio_upload,
+    sniff_audio_format,
+    split_sentences,
+    split_wav,
+    streaming_wav_header,
+)
+
+
+def make_wav(frames, extra_chunk=None):
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(8000)
+        w.writeframes(frames)
+    data = buf.getvalue()
+    if extra_chunk is not None:
+        # Insert an extra chunk between fmt and data, as some encoders do
+        riff, rest = data[:36], data[36:]
+        data = riff + extra_chunk + rest
+        data = data[:4] + (len(data) - 8).to_bytes(4, "little") + data[8:]
+    return data
+
+
+# === WAV helpers ===
+def test_split_wav_round_trip():
+    frames = b"\x01\x00\x02\x00\x03\x00"
+    header, pcm = split_wav(make_wav(frames))
+    assert header[-8:-4] == b"data"
+    assert pcm == frames
+
+
+def test_split_wav_skips_odd_sized_chunk_before_data():
+    frames = b"\x01\x00\x02\x00"
+    # 3-byte LIST chunk is followed by one pad byte
+    extra = b"LIST" + (3).to_bytes(4, "little") + b"abc" + b"\x00"
+    header, pcm = split_wav(make_wav(frames, extra_chunk=extra))
+    assert extra in header
+    assert pcm == frames
+
+
+def test_split_wav_without_data_chunk():
+    with pytest.raises(ValueError):
+        split_wav(b"RIFF\x04\x00\x00\x00WAVE")
+
+
+def test_join_wav_sizes():
+    joined = join_wav([make_wav(b"\x01\x00" * 10), make_wav(b"\x02\x00" * 5)])
+    assert int.from_bytes(joined[4:8], "little") == len(joined) - 8
+    header, pcm = split_wav(joined)
+    assert int.from_bytes(header[-4:], "little") == len(pcm) == 30
+    with wave.open(io.BytesIO(joined)) as w:
+        assert w.getnframes() == 15
+        assert w.readframes(15) == b"\x01\x00" * 10 + b"\x02\x00" * 5
+
+
+def test_streaming_wav_header_marks_sizes_unknown():
+    header, _ = split_wav(make_wav(b"\x01\x00"))
+    streaming = streaming_wav_header(header)
+    assert len(streaming) == len(header)
+    assert streaming[4:8] == b"\xff\xff\xff\xff"
+    assert streaming[-4:] == b"\xff\xff\xff\xff"
+    assert streaming[8:-4] == header[8:-4]
+
+
+# === Audio format sniffing ===
+@pytest.mark.parametrize("header, expected", [
+    (b"RIFF\x24\x00\x00\x00WAVE", (".wav", "audio/wav")),
+    (b"OggS\x00\x02\x00\x00\x00\x00\x00\x00", (".ogg", "audio/ogg")),
+    (b"\x1a\x45\xdf\xa3\x9f\x42\x86\x81\x01\x42\xf7\x81", (".webm", "audio/webm")),
+    (b"fLaC\x00\x00\x00\x22\x10\x00\x10\x00", (".flac", "audio/flac")),
+    (b"\x00\x00\x00\x20ftypM4A ", (".m4a", "audio/mp4")),
+    (b"ID3\x04\x00\x00\x00\x00\x00\x00\x00\x00", (".mp3", "audio/mpeg")),
+    (b"\xff\xfb\x90\x64\x00\x00\x00\x00\x00\x00\x00\x00", (".mp3", "audio/mpeg")),
+])
+def test_sniff_audio_format(header, expected):
+    assert sniff_audio_format(header) == expected
+
+
+@pytest.mark.parametrize("header", [
+    b"RIFF\x24\x00\x00\x00AVI ",
+    b"hello world!",
+    b"",
+])
+def test_sniff_audio_format_unknown(header):
+    assert sniff_audio_format(header) is None
+
+
+def make_upload(data, filename, content_type):
+    return UploadFile(io.BytesIO(data), filename=filename, headers=Headers({"content-type": content_type}))
+
+
+def test_read_audio_upload_uses_detected_format():
+    # Browsers record WebM even when the client names the blob .wav
+    data = b"\x1a\x45\xdf\xa3" + b"\x00" * 20
+    filename, audio_file, content_type = asyncio.run(
+        read_audio_upload(make_upload(data, "user_input.wav", "audio/wav"))
+    )
+    assert (filename, content_type) == ("user_input.webm", "audio/webm")
+    assert audio_file.read() == data
+
+
+def test_read_audio_upload_passes_unknown_audio_through():
+    upload = make_upload(b"\x00" * 16, "clip.amr", "audio/amr")
+    filename, _, content_type = asyncio.run(read_audio_upload(upload))
+    assert (filename, content_type) == ("clip.amr", "audio/amr")
+
+
+def test_read_audio_upload_rejects_non_audio():
+    upload = make_upload(b"plain text body", "notes.txt", "text/plain")
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(read_audio_upload(upload))
+    assert excinfo.value.status_code == 400
+
+
+# === TTS chunking ===
+def test_chunk_text_packs_whole_sentences():
+    text = "One. Two! Three? Four."
+    assert chunk_text(text, max_chars=10) == ["One. Two!", "Three?", "Four."]
+    assert chunk_text(text) == [text]
+
+
+def test_chunk_text_splits_long_sentence_on_words():
+    sentence = " ".join(["word"] * 100) + "."
+    chunks = chunk_text("Short one. " + sentence)
+    assert all(len(chunk) <= 300 for chunk in chunks)
+    # The 500-char sentence is wrapped into two pieces, neither fits beside "Short one."
+    assert [len(chunk) for chunk in chunks] == [10, 299, 200]
+    assert " ".join(chunks) == "Short one. " + sentence
+
+
+def test_synthesize_chunks_cancels_siblings_on_failure(monkeypatch):
+    cancelled = []
+
+    async def fake_synthesize_speech(text):
+        if text == "a":
+            raise HTTPException(status_code=429, detail="rate_limit_exceeded")
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(text)
+            raise
+
+    monkeypatch.setattr(ai_voice_agent, "synthesize_speech", fake_synthesize_speech)
+
+    async def run():
+        with pytest.raises(HTTPException) as excinfo:
+            await ai_voice_agent.synthesize_chunks(["a", "b", "c"])
+        # Siblings are already cancelled by the time the error propagates
+        assert sorted(cancelled) == ["b", "c"]
+        return excinfo.value
+
+    assert asyncio.run(run()).status_code == 429
+
+
+# === Conversation pipeline ===
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+async def collect(aiter):
+    return [item async for item in aiter]
+
+
+def test_split_sentences_across_deltas():
+    deltas = ["Hello the", "re. How are", " you?   ", "Fine", " thanks"]
+    sentences = asyncio.run(collect(split_sentences(iterate(deltas))))
+    assert sentences == ["Hello there.", "How are you?", "Fine thanks"]
+
+
+def test_split_sentences_ignores_blank_output():
+    assert asyncio.run(collect(split_sentences(iterate(["", "  ", "\n"])))) == []
+
+
+def test_converse_audio_yields_clips_in_sentence_order(monkeypatch):
+    clips = {"One.": b"\x01\x00", "Two.": b"\x02\x00\x02\x00", "Three.": b"\x03\x00"}
+    delays = {"One.": 0.03, "Two.": 0.0, "Three.": 0.01}
+
+    async def fake_synthesize_speech(text):
+        # Later sentences finish first; output must still follow the text
+        await asyncio.sleep(delays[text])
+        return make_wav(clips[text])
+
+    monkeypatch.setattr(ai_voice_agent, "synthesize_speech", fake_synthesize_speech)
+    parts = asyncio.run(collect(ai_voice_agent.converse_audio(iterate(["One. Two.", " Three."]))))
+    header, _ = split_wav(make_wav(b""))
+    assert parts == [streaming_wav_header(header), clips["One."], clips["Two."], clips["Three."]]
+
+
+def test_converse_audio_ends_cleanly_on_tts_failure(monkeypatch):
+    cancelled = []
+    closed = []
+
+    async def deltas():
+        try:
+            yield "One. Two. Three."
+            yield " Four."
+        finally:
+            closed.append(True)
+
+    async def fake_synthesize_speech(text):
+        if text == "One.":
+            return make_wav(b"\x01\x00")
+        if text == "Two.":
+            await asyncio.sleep(0.01)
+            raise HTTPException(status_code=429, detail="rate_limit_exceeded")
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled.append(text)
+            raise
+
+    monkeypatch.setattr(ai_voice_agent, "synthesize_speech", fake_synthesize_speech)
+    parts = asyncio.run(collect(ai_voice_agent.converse_audio(deltas())))
+    # Audio up to the failed sentence is delivered, then the stream just ends
+    assert parts[1:] == [b"\x01\x00"]
+    assert sorted(cancelled) == ["Four.", "Three."]
+    assert closed == [True]
+
+
+def test_converse_audio_caps_tts_input_length(monkeypatch):
+    requested = []
+
+    async def fake_synthesize_speech(text):
+        requested.append(text)
+        return make_wav(b"\x01\x00")
+
+    monkeypatch.setattr(ai_voice_agent, "synthesize_speech", fake_synthesize_speech)
+    sentence = " ".join(["word"] * 100) + "."
+    asyncio.run(collect(ai_voice_agent.converse_audio(iterate([sentence]))))
+    assert len(requested) == 2
+    assert all(len(text) <= ai_voice_agent.TTS_CHUNK_CHARS for text in requested)
+    assert " ".join(requested) == sentence
+
+
+def test_closing_stream_deltas_closes_upstream(fake_chat):
+    async def run():
+        deltas = await ai_voice_agent.stream_ai_response("Hello", [])
+        assert await deltas.__anext__() == "Hi"
+        await deltas.aclose()
+
+    asyncio.run(run())
+    assert fake_chat[0]["upstream"].closed
+
+
+def test_converse_rejects_bad_chat_history_before_transcribing(monkeypatch):
+    transcribed = []
+
+    async def fake_transcribe_audio(audio_tuple):
+        transcribed.append(audio_tuple)
+        return "hello"
+
+    monkeypatch.setattr(ai_voice_agent, "transcribe_audio", fake_transcribe_audio)
+    client = TestClient(ai_voice_agent.app)
+    for chat_history in ["not json", '{"a": 1}', '[{"user": 1, "ai": 2}]']:
+        response = client.post(
+            "/converse",
+            files={"file": ("clip.wav", make_wav(b"\x01\x00"), "audio/wav")},
+            data={"chat_history": chat_history},
+        )
+        assert response.status_code == 422
+    assert transcribed == []
+
+
+# === AI response ===
+class FakeStream:
+    # Stands in for the SDK's AsyncStream of chat completion chunks
+    def __init__(self, deltas):
+        self.deltas = deltas
+        self.closed = False
+
+    async def __aiter__(self):
+        for delta in self.deltas:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=delta))])
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_chat(monkeypatch):
+    # Records every chat completion request and answers with canned text
+    calls = []
+
+    async def fake_create(model, messages, stream=False):
+        calls.append({"model": model, "messages": messages, "stream": stream})
+        if not stream:
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content="Hi there."))])
+
+        calls[-1]["upstream"] = FakeStream(["Hi", None, " there."])
+        return calls[-1]["upstream"]
+
+    monkeypatch.setattr(ai_voice_agent.groq_client.chat.completions, "create", fake_create)
+    monkeypatch.setattr(ai_voice_agent, "response_cache", ai_voice_agent.LRUCache(maxsize=16))
+    return calls
+
+
+def test_identical_request_is_served_from_cache(fake_chat):
+    history = [{"user": "Hello", "ai": "Hi!"}]
+    first = asyncio.run(ai_voice_agent.get_ai_response("How are you?", history))
+    second = asyncio.run(ai_voice_agent.get_ai_response("How are you?", history))
+    assert first == second == "Hi there."
+    assert len(fake_chat) == 1
+
+
+def test_changed_history_misses_cache(fake_chat):
+    asyncio.run(ai_voice_agent.get_ai_response("How are you?", []))
+    asyncio.run(ai_voice_agent.get_ai_response("How are you?", [{"user": "Hello", "ai": "Hi!"}]))
+    assert len(fake_chat) == 2
+
+
+def test_cache_can_be_disabled(fake_chat, monkeypatch):
+    monkeypatch.setattr(ai_voice_agent, "RESPONSE_CACHE_ENABLED", False)
+    asyncio.run(ai_voice_agent.get_ai_response("How are you?", []))
+    asyncio.run(ai_voice_agent.get_ai_response("How are you?", []))
+    assert len(fake_chat) == 2
+
+
+def history_turns(count):
+    return [{"user": f"question {i}", "ai": f"answer {i}"} for i in range(count)]
+
+
+def test_build_messages_keeps_last_turns(monkeypatch):
+    monkeypatch.setattr(ai_voice_agent, "CHAT_HISTORY_WINDOW", 2)
+    messages = ai_voice_agent.build_messages("latest", history_turns(5))
+    assert messages[0] is ai_voice_agent.SYSTEM_MESSAGE
+    assert [m["content"] for m in messages[1:]] == [
+        "question 3", "answer 3", "question 4", "answer 4", "latest",
+    ]
+    assert [m["role"] for m in messages[1:]] == ["user", "assistant", "user", "assistant", "user"]
+
+
+def test_build_messages_short_history_is_kept_whole(monkeypatch):
+    monkeypatch.setattr(ai_voice_agent, "CHAT_HISTORY_WINDOW", 6)
+    assert len(ai_voice_agent.build_messages("latest", history_turns(3))) == 1 + 3 * 2 + 1
+
+
+def test_build_messages_zero_window_drops_history(monkeypatch):
+    monkeypatch.setattr(ai_voice_agent, "CHAT_HISTORY_WINDOW", 0)
+    messages = ai_voice_agent.build_messages("latest", history_turns(3))
+    assert messages == [ai_voice_agent.SYSTEM_MESSAGE, {"role": "user", "content": "latest"}]
+
+
+def test_windowed_history_reaches_groq(fake_chat, monkeypatch):
+    monkeypatch.setattr(ai_voice_agent, "CHAT_HISTORY_WINDOW", 1)
+    asyncio.run(ai_voice_agent.get_ai_response("latest", history_turns(4)))
+    sent = [m["content"] for m in fake_chat[0]["messages"][1:]]
+    assert sent == ["question 3", "answer 3", "latest"]
+
+
+def post_stream(prompt):
+    client = TestClient(ai_voice_agent.app)
+    return client.post("/generate_response/stream", json={"prompt": prompt, "chat_history": []})
+
+
+def test_stream_endpoint_sends_sse_events(fake_chat):
+    response = post_stream("Hello")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == 'data: {"t":"Hi"}\n\ndata: {"t":" there."}\n\n'
+    assert fake_chat[0]["stream"] is True
+
+
+def test_stream_fills_cache_and_replays_it_as_one_event(fake_chat):
+    post_stream("Hello")
+    # The non-streaming endpoint shares the cache filled by the stream
+    assert asyncio.run(ai_voice_agent.get_ai_response("Hello", [])) == "Hi there."
+    response = post_stream("Hello")
+    assert response.text == 'data: {"t":"Hi there."}\n\n'
+    assert len(fake_chat) == 1
+
+
+def test_stream_endpoint_rejects_empty_prompt(fake_chat):
+    assert post_stream("   ").status_code == 422
+    assert fake_chat == []
+
+
+# === CORS ===
+@pytest.mark.parametrize("origin, allowed", [
+    ("http://localhost:3000", True),
+    ("http://192.168.1.20:3000", True),
+    ("https://myapp.vercel.app", False),
+    ("http://localhost.evil.com", False),
+])
+def test_default_cors_origins(origin, allowed):
+    response = TestClient(ai_voice_agent.app).options("/tts", headers={
+        "Origin": origin,
+        "Access-Control-Request-Method": "POST",
+    })
+    assert (response.status_code == 200) is allowed
+    assert (response.headers.get("access-control-allow-origin") == origin) is allowed
+
+
+# === Semantic cache ===
+# Hand-picked unit vectors: "capital?" paraphrases "capital", "bread" is unrelated
+EMBEDDINGS = {
+    "capital": [1.0, 0.0, 0.0],
+    "capital?": [0.96, 0.28, 0.0],
+    "bread": [0.0, 1.0, 0.0],
+    "weather": [0.0, 0.0, 1.0],
+}
+
+
+@pytest.fixture
+def semantic_cache(monkeypatch):
+    np = pytest.importorskip("numpy")
+    monkeypatch.setattr(ai_voice_agent, "SEMANTIC_CACHE_ENABLED", True)
+    monkeypatch.setattr(ai_voice_agent, "RESPONSE_CACHE_ENABLED", False)
+    monkeypatch.setattr(ai_voice_agent, "semantic_cache", ai_voice_agent.LRUCache(maxsize=16))
+    monkeypatch.setattr(ai_voice_agent, "embed_prompt", lambda prompt: np.array(EMBEDDINGS[prompt]))
+    return ai_voice_agent.semantic_cache
+
+
+def remember(prompt, reply, history=()):
+    messages = ai_voice_agent.build_messages(prompt, list(history))
+    context_key, embedding, _ = asyncio.run(ai_voice_agent.semantic_cache_lookup("model", messages))
+    ai_voice_agent.semantic_cache_store(context_key, embedding, reply)
+
+
+def lookup(prompt, history=()):
+    messages = ai_voice_agent.build_messages(prompt, list(history))
+    return asyncio.run(ai_voice_agent.semantic_cache_lookup("model", messages))[2]
+
+
+def test_semantic_cache_hits_paraphrase(semantic_cache):
+    remember("capital", "Paris.")
+    remember("bread", "Knead it.")
+    assert lookup("capital?") == "Paris."
+    assert lookup("bread") == "Knead it."
+    assert lookup("weather") is None
+
+
+def test_semantic_cache_misses_with_different_history(semantic_cache):
+    remember("capital", "Paris.")
+    assert lookup("capital?", history=[{"user": "Hi", "ai": "Hello"}]) is None
+
+
+def test_semantic_cache_below_threshold_misses(semantic_cache, monkeypatch):
+    remember("capital", "Paris.")
+    # Similarity of the paraphrase is 0.96
+    monkeypatch.setattr(ai_voice_agent, "SEMANTIC_CACHE_THRESHOLD", 0.97)
+    assert lookup("capital?") is None
+
+
+def test_semantic_cache_evicts_oldest_entry(semantic_cache, monkeypatch):
+    monkeypatch.setattr(ai_voice_agent, "SEMANTIC_CACHE_ENTRIES", 2)
+    remember("capital", "Paris.")
+    remember("bread", "Knead it.")
+    remember("weather", "Sunny.")
+    assert lookup("capital") is None
+    assert lookup("bread") == "Knead it."
+    assert lookup("weather") == "Sunny."
+    embeddings, responses = next(iter(semantic_cache.values()))
+    assert embeddings.shape == (2, 3)
+    assert responses == ["Knead it.", "Sunny."]
+
+
+def test_semantic_cache_serves_both_endpoints(semantic_cache, fake_chat):
+    assert asyncio.run(ai_voice_agent.get_ai_response("capital", [])) == "Hi there."
+    assert asyncio.run(ai_voice_agent.get_ai_response("capital?", [])) == "Hi there."
+    assert len(fake_chat) == 1
+
+    # The streaming path stores its completed reply too
+    post_stream("bread")
+    assert len(fake_chat) == 2
+    assert asyncio.run(ai_voice_agent.get_ai_response("bread", [])) == "Hi there."
+    assert post_stream("bread").text == 'data: {"t":"Hi there."}\n\n'
+    assert len(fake_chat) == 2